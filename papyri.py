@@ -21,6 +21,9 @@ import sys
 import hashlib
 import time
 import struct
+import mmap
+import base64
+import bisect
 
 __author__ = "Jason Green"
 __copyright__ = "Copyright 2025, Tesseract Designs"
@@ -40,6 +43,22 @@ mapPngFilenameFormat = filenameSeparator.join(["{mapId}", "{mapHash}", "{epoch}"
 # now in epoch
 now = int(time.time())
 
+# the region file overlay is its own tile layer, next to the dimension it covers
+regionOverlaySuffix = "_regions"
+
+# the region file overlay is rendered at 2 blocks per pixel, a chunk is 8x8 pixels
+regionOverlayZoom = 15
+
+regionFileRegex = re.compile(r"^r\.(-?\d+)\.(-?\d+)\.mca$")
+
+# age limits in seconds of the newest chunk in a region file, and their overlay colors
+regionAgeLimits = [86400, 604800, 2592000, 31536000]
+regionAgeColors = [(251, 0, 4, 128),
+                   (190, 0, 64, 128),
+                   (128, 0, 128, 128),
+                   (64, 0, 190, 128),
+                   (4, 0, 251, 128)]
+
 
 # stuff to convert the map color data to RGB values
 multipliers = [180, 220, 255, 135]
@@ -119,6 +138,22 @@ def multiplyColor(colorTuple, multiplier):
 allColors = [multiplyColor(color, multiplier)
              for color in basecolors for multiplier in multipliers]
 
+# map images are stored paletted, a pixel is its map color index
+mapPalette = [a for color in allColors for a in color[:3]]
+mapTransparency = bytes([color[3] if len(color) == 4 else 255 for color in allColors])
+# the first index of each color, to turn RGBA map images back into map color indexes
+mapColorIndexes = {}
+for index, color in enumerate(allColors):
+    mapColorIndexes.setdefault(color if len(color) == 4 else color + (255,), index)
+
+
+def newMapImage(colorIndexes):
+    "creates a paletted 128x128 map image from map color indexes"
+    mapImage = Image.frombytes("P", (128, 128), bytes(colorIndexes))
+    mapImage.putpalette(mapPalette)
+    mapImage.info["transparency"] = mapTransparency
+    return mapImage
+
 # convert dimension names to/from human readable
 dimDict = {-1: "minecraft:the_nether",
            0: "minecraft:overworld",
@@ -368,11 +403,9 @@ def makeMaps(worldFolder, outputFolder, unlimitedTracking=False):
         # logging.debug(mapColors)
         
 
-        colorTuples = [allColors[x % 256] for x in mapColors]
-        mapImage = Image.new("RGBA", (128, 128))
-        mapImage.putdata(colorTuples)
+        mapImage = newMapImage([x % 256 for x in mapColors])
         
-        mapHash = hashlib.md5(mapImage.tobytes()).hexdigest()
+        mapHash = hashlib.md5(mapImage.convert("RGBA").tobytes()).hexdigest()
         
         # empty map
         if mapHash == "fcd6bcb56c1689fcef28b57c22475bad":
@@ -413,7 +446,7 @@ def makeMaps(worldFolder, outputFolder, unlimitedTracking=False):
                              scale=scale)
 
 
-        mapImage = mapImage.resize((128 * 2 ** scale,) * 2, Image.Resampling.NEAREST)
+        # the scale is only applied when compositing, maps are stored at 128x128
         filename = mapPngFilenameFormat.format(**mapPng._asdict())
         
         
@@ -423,7 +456,7 @@ def makeMaps(worldFolder, outputFolder, unlimitedTracking=False):
         except:
             logging.debug("%s isn't there, didn't delete", mapId)
 
-        mapImage.save(os.path.join(outputFolder, filename))
+        mapImage.save(os.path.join(outputFolder, filename), transparency=mapTransparency)
         
         mapData = MapTuple(mapData=mapPng,
                            bannerData=banners,
@@ -529,6 +562,14 @@ def mergeToLevel4(mapPngFolder, outputFolder, disablezoomsort):
                 mapPngFilename = mapPngFilenameFormat.format(**mapTuple._asdict()) 
                 # paste the image into the level 4 map
                 with Image.open(os.path.join(mapPngFolder, mapPngFilename)) as mapPng:
+                    if mapPng.size != (128, 128):
+                        # older versions stored maps already scaled up, store them at 128x128 instead
+                        logging.debug("%s is stored scaled up, shrinking it", mapPngFilename)
+                        mapPng = mapPng.convert("RGBA").resize((128, 128), Image.Resampling.NEAREST)
+                        # an exact lookup, quantizing to the palette picks near colors
+                        mapPng = newMapImage([mapColorIndexes.get(a, 0) for a in mapPng.getdata()])
+                        mapPng.save(os.path.join(mapPngFolder, mapPngFilename), transparency=mapTransparency)
+                    mapPng = mapPng.convert("RGBA").resize((128 * 2 ** mapTuple.scale,) * 2, Image.Resampling.NEAREST)
                     level4MapPng.paste(mapPng, mapPngCoords, mapPng)
             # figure out the name of the file, and save it
             fileName = filenameFormat.format(dimension=d, x=c[0], z=c[1]*-1)
@@ -538,14 +579,21 @@ def mergeToLevel4(mapPngFolder, outputFolder, disablezoomsort):
             level4MapPng.close()
 
 
-def genZoom17Tiles(level4MapFolder, outputFolder):
-    """generates lowest zoom level tiles from combined zoom level 4 maps"""
+def genNativeZoomTiles(level4MapFolder, outputFolder, maxNativeZoom=17):
+    """generates the deepest native zoom level tiles from combined zoom level 4 maps"""
 
     # get all the level 4 maps 
     globString = filenameSeparator.join(["*", "*", "*.png"])
     level4MapFilenames = glob.glob(os.path.join(level4MapFolder, globString))
+
+    # tiles deeper than the native zoom level aren't used anymore
+    for deeperZoom in range(maxNativeZoom + 1, 18):
+        for foldername in glob.glob(os.path.join(outputFolder, "*", str(deeperZoom))):
+            logging.info("Removing unused tiles in %s", foldername)
+            shutil.rmtree(foldername)
+
     # iterate over level4 maps
-    for level4MapFilename in tqdm(level4MapFilenames, "level 4 -> zoom 17 tiles", bar_format="{l_bar}{bar}"):
+    for level4MapFilename in tqdm(level4MapFilenames, "level 4 -> zoom {} tiles".format(maxNativeZoom), bar_format="{l_bar}{bar}"):
         # get some details
         name = os.path.basename(level4MapFilename)
         dim, x, z, _ = name.split(filenameSeparator)
@@ -555,25 +603,26 @@ def genZoom17Tiles(level4MapFolder, outputFolder):
         tilez = level4z // 2048 * -1
         # open the level 4 map
         with Image.open(level4MapFilename) as level4MapPng:
-            # this is pretty useless
-            for zoom in range(17, 18):
-                numTiles = 2 ** (zoom - 13)
-                imageWidth = 2048 // numTiles
-                # do math
-                for numx in range(numTiles):
-                    levelNumx = tilex * numTiles + numx
-                    foldername = os.path.join(outputFolder, dim, str(zoom), str(levelNumx))
-                    os.makedirs(foldername, exist_ok=True)
-                    for numz in range(numTiles):
-                        levelNumz = tilez * numTiles + numz
-                        cropBox = (numx * imageWidth,
-                                numz * imageWidth,
-                                numx * imageWidth + imageWidth,
-                                numz * imageWidth + imageWidth)
-                        filename = os.path.join(foldername, str(levelNumz) + ".png")
-                        tilePng = level4MapPng.crop(cropBox)
+            zoom = maxNativeZoom
+            numTiles = 2 ** (zoom - 13)
+            # at zoom 16 a block is a pixel, at zoom 17 they get upscaled
+            imageWidth = 2048 // numTiles
+            # do math
+            for numx in range(numTiles):
+                levelNumx = tilex * numTiles + numx
+                foldername = os.path.join(outputFolder, dim, str(zoom), str(levelNumx))
+                os.makedirs(foldername, exist_ok=True)
+                for numz in range(numTiles):
+                    levelNumz = tilez * numTiles + numz
+                    cropBox = (numx * imageWidth,
+                            numz * imageWidth,
+                            numx * imageWidth + imageWidth,
+                            numz * imageWidth + imageWidth)
+                    filename = os.path.join(foldername, str(levelNumz) + ".png")
+                    tilePng = level4MapPng.crop(cropBox)
+                    if imageWidth != 256:
                         tilePng = tilePng.resize((256, 256), Image.Resampling.NEAREST)
-                        tilePng.save(filename)
+                    tilePng.save(filename)
 
 
 def extrapolateZoom(tileFolder, level):
@@ -582,6 +631,9 @@ def extrapolateZoom(tileFolder, level):
     for filename in zoom17Filenames:
         tilePath = os.path.relpath(filename, tileFolder)
         dim, zoom, x, y = tilePath.strip(".png").split(os.sep)
+        # the region file overlay keeps its own tiles up to date
+        if dim.endswith(regionOverlaySuffix):
+            continue
         x = int(x)
         y = int(y)
         xnew, xq = divmod(x, 2)
@@ -599,6 +651,190 @@ def extrapolateZoom(tileFolder, level):
         tilePng.save(os.path.join(foldername, "{}.png".format(newTile[0][2])))
 
 
+def findRegionFolders(worldFolder):
+    """returns the region folder of each dimension in a java world"""
+    # the world folder is wherever level.dat is
+    for folder in os.walk(worldFolder):
+        if "level.dat" in folder[2]:
+            worldFolder = folder[0]
+            break
+
+    candidates = [("minecraft@overworld", os.path.join(worldFolder, "region")),
+                  ("minecraft@the_nether", os.path.join(worldFolder, "DIM-1", "region")),
+                  ("minecraft@the_end", os.path.join(worldFolder, "DIM1", "region"))]
+
+    # custom dimensions live in dimensions/<namespace>/<name>/region
+    for folder in glob.glob(os.path.join(worldFolder, "dimensions", "*", "*", "region")):
+        namespace, name = os.path.relpath(folder, worldFolder).split(os.sep)[1:3]
+        candidates.append(("@".join([namespace, name]), folder))
+
+    return {dimension: folder for dimension, folder in candidates if os.path.isdir(folder)}
+
+
+def readRegionHeader(regionFilename):
+    """reads which chunks exist and when the newest one was saved, only from the region file header"""
+    with open(regionFilename, "rb") as f:
+        # empty or truncated region files have no chunks
+        if os.fstat(f.fileno()).st_size < 8192:
+            return bytes(128), 0
+        with mmap.mmap(f.fileno(), 8192, access=mmap.ACCESS_READ) as header:
+            locations = struct.unpack_from(">1024I", header, 0)
+            timestamps = struct.unpack_from(">1024I", header, 4096)
+
+    # one bit per chunk, in the same order as the header
+    chunks = bytearray(128)
+    newest = 0
+    for i, location in enumerate(locations):
+        if location:
+            chunks[i >> 3] |= 1 << (i & 7)
+            newest = max(newest, timestamps[i])
+
+    return bytes(chunks), newest
+
+
+def drawRegion(draw, chunks, offset, color):
+    """draws the chunks of a region onto an overlay tile, one rectangle per run of chunks in a row"""
+    for cz in range(32):
+        runStart = None
+        for cx in range(33):
+            i = cz * 32 + cx
+            exists = cx < 32 and chunks[i >> 3] >> (i & 7) & 1
+            if exists and runStart is None:
+                runStart = cx
+            elif not exists and runStart is not None:
+                draw.rectangle((offset[0] + runStart * 8,
+                                offset[1] + cz * 8,
+                                offset[0] + cx * 8 - 1,
+                                offset[1] + cz * 8 + 7), fill=color)
+                runStart = None
+
+
+def mergeChildTiles(tileFolder, layerId, level, x, z):
+    """regenerates a single tile from the 4 tiles below it, removes it if there are none"""
+    filename = os.path.join(tileFolder, layerId, str(level), str(x), "{}.png".format(z))
+    tilePng = Image.new("RGBA", (512, 512))
+    found = False
+    for xq in range(2):
+        for zq in range(2):
+            childFilename = os.path.join(tileFolder, layerId, str(level + 1), str(x * 2 + xq), "{}.png".format(z * 2 + zq))
+            if not os.path.isfile(childFilename):
+                continue
+            found = True
+            with Image.open(childFilename) as childTilePng:
+                tilePng.paste(childTilePng, (xq * 256, zq * 256))
+
+    if not found:
+        if os.path.isfile(filename):
+            os.remove(filename)
+        return
+
+    tilePng = tilePng.resize((256, 256), Image.Resampling.NEAREST)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tilePng.save(filename)
+
+
+def genRegionOverlay(worldFolder, tileFolder, outputFolder):
+    """generates the region file overlay tiles, only redoing tiles of region files that changed"""
+    cacheFilename = os.path.join(outputFolder, "regions-cache.json")
+    try:
+        with open(cacheFilename, encoding="utf-8") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        logging.info("No region file cache found, reading all region files")
+        cache = {"regions": {}, "tiles": {}}
+
+    regionFolders = findRegionFolders(worldFolder)
+    if not regionFolders:
+        logging.info("Didn't find any region files, did you specify the correct world location?")
+
+    newCache = {"regions": {}, "tiles": {}}
+
+    for dimension, regionFolder in regionFolders.items():
+        layerId = dimension + regionOverlaySuffix
+        cachedRegions = cache["regions"].get(layerId, {})
+        regions = {}
+        readCount = 0
+
+        # only the headers of region files with a new mtime are read
+        with os.scandir(regionFolder) as entries:
+            for entry in entries:
+                if not regionFileRegex.match(entry.name):
+                    continue
+                mtime = int(entry.stat().st_mtime)
+                cachedRegion = cachedRegions.get(entry.name)
+                if cachedRegion and cachedRegion[0] == mtime:
+                    regions[entry.name] = cachedRegion
+                    continue
+                chunks, newest = readRegionHeader(entry.path)
+                regions[entry.name] = [mtime, newest, base64.b64encode(chunks).decode("ascii")]
+                readCount += 1
+
+        logging.info("Read %s of %s region file headers in %s", readCount, len(regions), dimension)
+
+        # a region is offset by 64 blocks from the tiles, so it touches 4 of them
+        tileInputs = defaultdict(list)
+        for name, (mtime, newest, chunks) in regions.items():
+            if not newest:
+                continue
+            rx, rz = (int(a) for a in regionFileRegex.match(name).groups())
+            ageBucket = bisect.bisect_left(regionAgeLimits, now - newest)
+            for tx in (rx, rx + 1):
+                for tz in (rz, rz + 1):
+                    tileInputs[(tx, tz)].append((rx, rz, mtime, ageBucket, chunks))
+
+        cachedTiles = cache["tiles"].get(layerId, {})
+        tiles = {}
+        changedTiles = set()
+        for coords, inputs in tileInputs.items():
+            key = filenameSeparator.join(str(a) for a in coords)
+            tiles[key] = hashlib.md5(repr(sorted(inputs)).encode()).hexdigest()
+            # tiles deleted from disk are redrawn even if the cache says they are current
+            tileFilename = os.path.join(tileFolder, layerId, str(regionOverlayZoom), str(coords[0]), "{}.png".format(coords[1]))
+            if cachedTiles.get(key) != tiles[key] or not os.path.isfile(tileFilename):
+                changedTiles.add(coords)
+
+        # tiles without any regions left
+        removedTiles = {tuple(int(a) for a in key.split(filenameSeparator)) for key in cachedTiles if key not in tiles}
+
+        for tx, tz in tqdm(changedTiles, "regions of dim: {}".format(dimension).ljust(24), bar_format="{l_bar}{bar}"):
+            tilePng = Image.new("RGBA", (256, 256))
+            draw = ImageDraw.Draw(tilePng)
+            for rx, rz, _, ageBucket, chunks in tileInputs[(tx, tz)]:
+                offset = ((rx - tx) * 256 + 32, (rz - tz) * 256 + 32)
+                drawRegion(draw, base64.b64decode(chunks), offset, regionAgeColors[ageBucket])
+            foldername = os.path.join(tileFolder, layerId, str(regionOverlayZoom), str(tx))
+            os.makedirs(foldername, exist_ok=True)
+            tilePng.save(os.path.join(foldername, "{}.png".format(tz)))
+
+        for tx, tz in removedTiles:
+            filename = os.path.join(tileFolder, layerId, str(regionOverlayZoom), str(tx), "{}.png".format(tz))
+            if os.path.isfile(filename):
+                os.remove(filename)
+
+        # only the tiles above changed tiles need to be regenerated
+        changedTiles |= removedTiles
+        for level in range(regionOverlayZoom - 1, -1, -1):
+            changedTiles = {(x // 2, z // 2) for x, z in changedTiles}
+            for x, z in changedTiles:
+                mergeChildTiles(tileFolder, layerId, level, x, z)
+
+        newCache["regions"][layerId] = regions
+        newCache["tiles"][layerId] = tiles
+
+    with open(cacheFilename, "w", encoding="utf-8") as f:
+        json.dump(newCache, f)
+
+    # tells the web page which dimensions have a region file overlay
+    with open(os.path.join(outputFolder, "regions.json"), "w", encoding="utf-8") as f:
+        f.write(json.dumps(list(regionFolders)))
+
+
+def genTileSettings(outputFolder, maxNativeZoom):
+    """generate the tiles.json file with the settings the tile layers need"""
+    with open(os.path.join(outputFolder, "tiles.json"), "+w", encoding="utf-8") as f:
+        f.write(json.dumps({"maxNativeZoom": maxNativeZoom}))
+
+
 def genBannerMarkers(maps, outputFolder):
     """generate the banner.json file from maps list"""
     logging.debug(maps)
@@ -669,7 +905,8 @@ def main():
     parser.add_argument('--world', help="location of your world folder or save folder", required=True)
     parser.add_argument('--includeunlimitedtracking', help="include maps that have unlimited tracking on, this includes older maps from previous Minecraft versions and treasure maps in +1.13", action="store_true")
     parser.add_argument('--disablezoomsort', help="don't sort maps by zoom level before rendering, newer maps of higher zoom level will cover lower level maps", action="store_true")
-    #parser.add_argument('--overlaymca', help="generate the regionfile overlay (Java only)", action="store_true")
+    parser.add_argument('--maxnativezoom', help="deepest zoom level to generate tiles for, 16 is one block per pixel, 17 upscales those 2x", type=int, choices=[16, 17], default=17)
+    parser.add_argument('--overlaymca', help="generate the regionfile overlay (Java only)", action="store_true")
     parser.add_argument('--output', help="output path for web stuff", required=True)
     parser.add_argument('--copytemplate', help="copy default index.html and assets (do this if a new release changes the tempalte)", action="store_true")
     parser.add_argument('--debug', help="show debug logging", action="store_true")
@@ -700,13 +937,24 @@ def main():
     # make the level 4 maps
     mergeToLevel4(mapsOutput, mergedMapsOutput, disablezoomsort=args.disablezoomsort)
 
-    # create the tiles for the lowest zoom level
-    genZoom17Tiles(mergedMapsOutput, tileOutput)
+    # tell the web page how deep the tiles go
+    genTileSettings(args.output, args.maxnativezoom)
+
+    # create the tiles for the deepest native zoom level
+    genNativeZoomTiles(mergedMapsOutput, tileOutput, maxNativeZoom=args.maxnativezoom)
 
-    # generate the rest of the zoom levels from level 17
-    for zoom in range(16, -1, -1):
+    # generate the rest of the zoom levels from the deepest one
+    for zoom in range(args.maxnativezoom - 1, -1, -1):
         extrapolateZoom(tileOutput, zoom)
-    
+
+    # make the region file overlay
+    if args.overlaymca:
+        genRegionOverlay(args.world, tileOutput, args.output)
+    else:
+        # stop offering an overlay that isn't kept up to date anymore
+        with open(os.path.join(args.output, "regions.json"), "w", encoding="utf-8") as f:
+            f.write(json.dumps([]))
+
     # make the banner markers
     genBannerMarkers(latestMaps, args.output)
 